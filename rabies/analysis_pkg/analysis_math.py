@@ -29,6 +29,30 @@ def elementwise_spearman(X,Y):
     return elementwise_corrcoef(X_ranks, Y_ranks)
     
 
+def center_and_normalize(X):
+    # X is of shape num_observations X num_element
+    # each element is centered and scaled to unit norm across observations
+    Xc = X-X.mean(axis=0)
+    return Xc/np.sqrt((Xc**2).sum(axis=0))
+
+
+def batch_elementwise_corrcoef(X_list, Y):
+    # computes elementwise_corrcoef between Y and each array of X_list
+    # Y is only standardized once for the whole batch
+    return normalized_elementwise_corrcoef(X_list, center_and_normalize(Y))
+
+
+def normalized_elementwise_corrcoef(X_list, Y_norm):
+    # same as batch_elementwise_corrcoef, but Y_norm was already centered and normalized with center_and_normalize
+    return [(center_and_normalize(X)*Y_norm).sum(axis=0) for X in X_list]
+
+
+def batch_elementwise_spearman(X_list, Y):
+    Y_ranks = Y.argsort(axis=0).argsort(axis=0)
+    X_ranks_list = [X.argsort(axis=0).argsort(axis=0) for X in X_list]
+    return batch_elementwise_corrcoef(X_ranks_list, Y_ranks)
+
+
 def dice_coefficient(mask1,mask2):
     dice = np.sum(mask1*mask2)*2.0 / (np.sum(mask1) + np.sum(mask2))
     return dice
@@ -3,15 +3,16 @@ import numpy as np
 import matplotlib.pyplot as plt
 import nilearn
 from rabies.visualization import otsu_scaling, plot_3d
-from rabies.analysis_pkg.analysis_math import elementwise_spearman, elementwise_corrcoef, dice_coefficient
+from rabies.analysis_pkg.analysis_math import batch_elementwise_spearman, normalized_elementwise_corrcoef, dice_coefficient
 from rabies.utils import recover_3D
 from rabies.confound_correction_pkg.utils import smooth_image
 import tempfile
 
 
-def analysis_QC(FC_maps, consensus_network, mask_file, corr_variable, variable_name, template_file, non_parametric=False):
+def analysis_QC(FC_maps, consensus_network, mask_file, corr_variable, variable_name, template_file, non_parametric=False, scaled=None):
 
-    scaled = otsu_scaling(template_file)
+    if scaled is None: # the scaled template can be provided to avoid re-computing it across repeated calls
+        scaled = otsu_scaling(template_file)
         
     smoothing=True
     if non_parametric:
@@ -37,24 +38,24 @@ def get_maps(prior, prior_list, corr_variable, mask_file, smoothing=False, non_p
     volume_indices=sitk.GetArrayFromImage(sitk.ReadImage(mask_file)).astype(bool)    
 
     Y=np.array(prior_list)
+    # the correlations with each variable are computed as a batch, to standardize the FC maps only once
+    X_list = [np.array(variable) for variable in corr_variable]
     if non_parametric:
         average=np.median(Y, axis=0)
         # compute MAD to be resistant to outliers
-        mad = np.median(np.abs(Y-np.median(Y, axis=0)), axis=0)
+        mad = np.median(np.abs(Y-average), axis=0)
         network_var=mad
+        corr_maps = batch_elementwise_spearman(X_list,Y)
     else:
+        # the centered maps are computed once, and shared between the STD and the correlations
         average=Y.mean(axis=0)
-        network_var=Y.std(axis=0)
+        Y_centered=Y-average
+        network_var=np.sqrt((Y_centered**2).mean(axis=0))
+        Y_norm=Y_centered/(network_var*np.sqrt(Y.shape[0]))
+        corr_maps = normalized_elementwise_corrcoef(X_list,Y_norm)
     maps.append(average)
     maps.append(network_var)
-        
-    for variable in corr_variable:    
-        X=np.array(variable)
-        if non_parametric:
-            corr_map = elementwise_spearman(X,Y)
-        else:
-            corr_map = elementwise_corrcoef(X,Y)
-        maps.append(corr_map)
+    maps += corr_maps
         
     if smoothing:
         mask_img = sitk.ReadImage(mask_file)
@@ -65,8 +65,9 @@ def process_data(data_dict, analysis_dict, prior_bold_idx, prior_confound_idx):
     if len(analysis_dict['seed_map_files'])>0:
         seed_list=[]
         for seed_map in analysis_dict['seed_map_files']:
-            seed_list.append(np.asarray(
-                sitk.GetArrayFromImage(sitk.ReadImage(seed_map)))[volume_indices])
+            # the array view avoids copying the whole volume before masking
+            seed_img = sitk.ReadImage(seed_map)
+            seed_list.append(sitk.GetArrayViewFromImage(seed_img)[volume_indices])
         spatial_info['seed_map_list'] = seed_list
         time_list=[]
         for time_csv in analysis_dict['seed_timecourse_csv']:
@@ -78,13 +79,12 @@ def process_data(data_dict, analysis_dict, prior_bold_idx, prior_confound_idx):
 
     ### DR analysis
     DR_W = np.array(pd.read_csv(analysis_dict['dual_regression_timecourse_csv'], header=None))
-    DR_array = sitk.GetArrayFromImage(
-        sitk.ReadImage(analysis_dict['dual_regression_nii']))
+    DR_img = sitk.ReadImage(analysis_dict['dual_regression_nii'])
+    DR_array = sitk.GetArrayViewFromImage(DR_img)
     if len(DR_array.shape)==3: # if there was only one component, need to convert to 4D array
         DR_array = DR_array[np.newaxis,:,:,:]
-    DR_C = np.zeros([DR_array.shape[0], volume_indices.sum()])
-    for i in range(DR_array.shape[0]):
-        DR_C[i, :] = (DR_array[i, :, :, :])[volume_indices]
+    # only the voxels within the mask are copied out of the image buffer
+    DR_C = DR_array[:, volume_indices]
 
     temporal_info['DR_all'] = DR_W
     temporal_info['DR_bold'] = DR_W[:, prior_bold_idx]
@@ -110,15 +110,12 @@ def process_data(data_dict, analysis_dict, prior_bold_idx, prior_confound_idx):
     prior_fit_out = {'C': [], 'W': []}
     if not analysis_dict['NPR_prior_filename'] is None:
         prior_fit_out['W'] = np.array(pd.read_csv(analysis_dict['NPR_prior_timecourse_csv'], header=None))
-        C_array = sitk.GetArrayFromImage(
-            sitk.ReadImage(analysis_dict['NPR_prior_filename']))
+        C_img = sitk.ReadImage(analysis_dict['NPR_prior_filename'])
+        C_array = sitk.GetArrayViewFromImage(C_img)
         if len(C_array.shape)==3: # if there was only one component, need to convert to 4D array
             C_array = C_array[np.newaxis,:,:,:]
 
-        C = np.zeros([C_array.shape[0], volume_indices.sum()])
-        for i in range(C_array.shape[0]):
-            C[i, :] = (C_array[i, :, :, :])[volume_indices]
-        prior_fit_out['C'] = C
+        prior_fit_out['C'] = C_array[:, volume_indices]
 
     spatial_info['prior_maps'] = data_dict['prior_map_vectors'][prior_bold_idx]
     spatial_info['DR_BOLD'] = DR_C[prior_bold_idx]
@@ -25,6 +25,7 @@ def init_diagnosis_wf(analysis_opts, commonspace_bold, preprocess_opts, split_na
         prior_confound_idx=analysis_opts.prior_confound_idx,
             DSURQE_regions=DSURQE_regions,
             figure_format=analysis_opts.figure_format, 
+            skip_figures=analysis_opts.skip_scan_figures,
             ),
         name='ScanDiagnosis')
 
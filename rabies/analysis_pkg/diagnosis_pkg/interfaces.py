@@ -32,18 +32,24 @@ class PrepMasks(BaseInterface):
     output_spec = PrepMasksOutputSpec
 
     def _run_interface(self, runtime):
-        from rabies.utils import flatten_list,resample_image_spacing
-        merged = flatten_list(list(self.inputs.mask_dict_list))
-        mask_dict = merged[0]  # all mask files are assumed to be identical
+        from rabies.utils import resample_image_spacing
+        # all mask files are assumed to be identical, so only the first entry of the nested lists is retrieved
+        mask_dict = self.inputs.mask_dict_list[0]
+        while isinstance(mask_dict, list):
+            mask_dict = mask_dict[0]
         brain_mask_file = mask_dict['mask_file']
         WM_mask_file = mask_dict['WM_mask_file']
         CSF_mask_file = mask_dict['CSF_mask_file']
 
+        # only the header of the brain mask is read to get the EPI dimensions
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(brain_mask_file)
+        reader.ReadImageInformation()
+
         # resample the template to the EPI dimensions
-        resampled = resample_image_spacing(sitk.ReadImage(mask_dict['preprocess_anat_template']), sitk.ReadImage(
-            brain_mask_file).GetSpacing())
+        resampled = resample_image_spacing(sitk.ReadImage(mask_dict['preprocess_anat_template']), reader.GetSpacing())
         template_file = os.path.abspath('display_template.nii.gz')
-        sitk.WriteImage(resampled, template_file)
+        sitk.WriteImage(sitk.Cast(resampled, sitk.sitkFloat32), template_file)
 
         if self.inputs.DSURQE_regions:
             if 'XDG_DATA_HOME' in os.environ.keys():
@@ -85,6 +91,8 @@ class ScanDiagnosisInputSpec(BaseInterfaceInputSpec):
         desc="Whether to use the regional masks generated from the DSURQE atlas for the grayplots outputs. Requires using the DSURQE template for preprocessing.")
     figure_format = traits.Str(
         desc="Select file format for figures.")
+    skip_figures = traits.Bool(False, usedefault=True,
+        desc="Whether to skip rendering the figures, and only write empty placeholder files.")
 
 
 class ScanDiagnosisOutputSpec(TraitedSpec):
@@ -113,26 +121,40 @@ class ScanDiagnosis(BaseInterface):
 
     def _run_interface(self, runtime):
         import pickle
+        # figures are rendered off-screen, since scans are processed in parallel workers
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
         with open(self.inputs.dict_file, 'rb') as handle:
             data_dict = pickle.load(handle)
 
         figure_format = self.inputs.figure_format
 
-        # convert to an integer list
-        prior_bold_idx = [int(i) for i in self.inputs.prior_bold_idx]
-        prior_confound_idx = [int(i) for i in self.inputs.prior_confound_idx]
+        # convert to integer index arrays
+        prior_bold_idx = np.asarray(self.inputs.prior_bold_idx, dtype=np.int64)
+        prior_confound_idx = np.asarray(self.inputs.prior_confound_idx, dtype=np.int64)
 
         temporal_info, spatial_info = diagnosis_functions.process_data(
             data_dict, self.inputs.analysis_dict, prior_bold_idx, prior_confound_idx)
 
-        fig, fig2 = diagnosis_functions.scan_diagnosis(data_dict, temporal_info,
-                                   spatial_info, regional_grayplot=self.inputs.DSURQE_regions)
-
         import pathlib
         filename_template = pathlib.Path(data_dict['name_source']).name.rsplit(".nii")[0]
         figure_path = os.path.abspath(filename_template)
-        fig.savefig(figure_path+f'_temporal_diagnosis.{figure_format}', bbox_inches='tight')
-        fig2.savefig(figure_path+f'_spatial_diagnosis.{figure_format}', bbox_inches='tight')
+        if self.inputs.skip_figures:
+            # only write placeholders, so that the output files exist for the datasink
+            for suffix in ['_temporal_diagnosis', '_spatial_diagnosis']:
+                open(figure_path+f'{suffix}.{figure_format}', 'w').close()
+        else:
+            fig, fig2 = diagnosis_functions.scan_diagnosis(data_dict, temporal_info,
+                                    spatial_info, regional_grayplot=self.inputs.DSURQE_regions)
+
+            # a low PNG compression level reduces encoding time, at the cost of slightly larger files
+            savefig_kwargs = {'pil_kwargs': {'compress_level': 1}} if figure_format=='png' else {}
+            fig.savefig(figure_path+f'_temporal_diagnosis.{figure_format}', bbox_inches='tight', **savefig_kwargs)
+            fig2.savefig(figure_path+f'_spatial_diagnosis.{figure_format}', bbox_inches='tight', **savefig_kwargs)
+            # close the figures so they don't accumulate in workers that are re-used across scans
+            plt.close(fig)
+            plt.close(fig2)
 
         setattr(self, 'figure_temporal_diagnosis',
                 figure_path+f'_temporal_diagnosis.{figure_format}')
@@ -186,9 +208,11 @@ class DatasetDiagnosis(BaseInterface):
 
     def _run_interface(self, runtime):
         import pathlib
+        import csv
         import matplotlib.pyplot as plt
         from rabies.utils import flatten_list
         from .analysis_QC import analysis_QC,QC_distributions
+        from rabies.visualization import otsu_scaling
 
         figure_format = self.inputs.figure_format
 
@@ -213,45 +237,61 @@ class DatasetDiagnosis(BaseInterface):
 
         template_file = merged[0]['template_file']
         mask_file = merged[0]['mask_file']
-        brain_mask = sitk.GetArrayFromImage(sitk.ReadImage(mask_file))
-        volume_indices = brain_mask.astype(bool)
+        mask_img = sitk.ReadImage(mask_file)
+        volume_indices = sitk.GetArrayViewFromImage(mask_img).astype(bool)
+
+        num_voxels = volume_indices.sum()
+
+        # exclude scans with a majority of 0s; indicates misregistration
+        # voxels with 0 STD in any of the included scans are also accumulated, to be masked out from the group stats
+        included_scans = []
+        any_zero = np.zeros(num_voxels, dtype=bool)
+        for scan_data in merged:
+            if np.median(scan_data['predicted_std'])==0:
+                continue
+            included_scans.append(scan_data)
+            any_zero |= (scan_data['temporal_std']==0)
+        non_zero_voxels = ~any_zero
+        # the flat indices are used for all subsequent masking, to avoid re-scanning the boolean mask on each call
+        non_zero_idx = np.flatnonzero(non_zero_voxels)
+
+        # the group arrays are pre-allocated and filled by scan, instead of stacking lists of arrays
+        # single precision is sufficient for the cross-scan statistics, and halves the memory footprint
+        num_scans = len(included_scans)
+        num_non_zero = len(non_zero_idx)
+        dtype = np.float32
+        mean_maps=np.empty([num_scans, num_non_zero], dtype=dtype)
+        std_maps=np.empty([num_scans, num_non_zero], dtype=dtype)
+        CRsd_maps=np.empty([num_scans, num_non_zero], dtype=dtype)
 
         scan_name_list=[]
-        mean_maps=[]
-        std_maps=[]
-        CRsd_maps=[]
         tdof_list=[]
         mean_FD_list=[]
         total_CRsd_list=[]
 
         FC_maps_dict={}
-        FC_maps_dict['DR']=[]
-        FC_maps_dict['NPR']=[]
-        FC_maps_dict['SBC']=[]
-        
+        for key,map_key in zip(['DR','NPR','SBC'],['DR_BOLD','NPR_maps','seed_map_list']):
+            num_maps = len(included_scans[0][map_key])
+            FC_maps_dict[key]=np.empty([num_scans, num_maps, num_voxels], dtype=dtype)
+
         DR_conf_corr_dict={}
         DR_conf_corr_dict['DR']=[]
         DR_conf_corr_dict['NPR']=[]
         DR_conf_corr_dict['SBC']=[]
 
-        for scan_data in merged:
-            temporal_std = scan_data['temporal_std']
-            CRsd = scan_data['predicted_std']
-            if np.median(CRsd)==0:
-                # exclude scans with a majority of 0s; indicates misregistration
-                continue
+        for scan_i,scan_data in enumerate(included_scans):
             scan_name = pathlib.Path(scan_data['name_source']).name.rsplit(".nii")[0]
             scan_name_list.append(scan_name)
-            mean_maps.append(scan_data['voxelwise_mean'])            
-            std_maps.append(temporal_std)
-            CRsd_maps.append(CRsd)
+            np.take(scan_data['voxelwise_mean'], non_zero_idx, out=mean_maps[scan_i])
+            np.take(scan_data['temporal_std'], non_zero_idx, out=std_maps[scan_i])
+            np.take(scan_data['predicted_std'], non_zero_idx, out=CRsd_maps[scan_i])
             total_CRsd_list.append(scan_data['CR_global_std'])
             tdof_list.append(scan_data['tDOF'])
             mean_FD_list.append(scan_data['FD_trace'].to_numpy().mean())
 
-            FC_maps_dict['DR'].append(scan_data['DR_BOLD'])
-            FC_maps_dict['NPR'].append(scan_data['NPR_maps'])
-            FC_maps_dict['SBC'].append(scan_data['seed_map_list'])
+            for key,map_key in zip(['DR','NPR','SBC'],['DR_BOLD','NPR_maps','seed_map_list']):
+                if FC_maps_dict[key].shape[1]>0:
+                    FC_maps_dict[key][scan_i] = scan_data[map_key]
 
             # computing the temporal correlation between network and confound timecourses
             DR_confound_time = scan_data['DR_confound_time']
@@ -267,19 +307,14 @@ class DatasetDiagnosis(BaseInterface):
         pd.DataFrame(scan_name_list).to_csv(f'{out_dir_global}/analysis_QC_scanlist.txt', index=None, header=False)
 
         from rabies.utils import recover_3D
-        std_maps=np.array(std_maps)
-        non_zero_voxels = ((std_maps==0).sum(axis=0).astype(bool)==0)
         non_zero_mask = os.path.abspath('non_zero_mask.nii.gz')
-        sitk.WriteImage(recover_3D(mask_file, non_zero_voxels.astype(float)), non_zero_mask)
-
-        CRsd_maps=np.array(CRsd_maps)[:,non_zero_voxels]
+        # the mask is kept as float, since analysis_QC smooths with it and integer masks get truncated
+        sitk.WriteImage(recover_3D(mask_file, non_zero_voxels), non_zero_mask)
 
         corr_variable = []
         variable_name = []
         if self.inputs.extended_QC:
-            mean_maps=np.array(mean_maps)[:,non_zero_voxels]
-            BOLD_std_maps=np.array(std_maps)[:,non_zero_voxels]
-            corr_variable += [mean_maps,BOLD_std_maps]
+            corr_variable += [mean_maps,std_maps]
             variable_name += ['BOLD mean', '$\mathregular{BOLD_{SD}}$']
 
         corr_variable += [CRsd_maps, np.array(mean_FD_list).reshape(-1,1)]
@@ -289,40 +324,44 @@ class DatasetDiagnosis(BaseInterface):
         total_CRsd = np.array(total_CRsd_list)
 
         # tdof effect; if there's no variability don't compute
-        if not np.array(tdof_list).std()==0:
-            tdof = np.array(tdof_list).reshape(-1,1)
-            corr_variable.append(tdof)
+        tdof_array = np.asarray(tdof_list)
+        if tdof_array.min()!=tdof_array.max():
+            corr_variable.append(tdof_array.reshape(-1,1))
             variable_name.append('tDOF')
-            tdof_array = np.array(tdof_list)
         else:
             tdof_array = None
 
-        def change_columns(df):
-            columns = list(df.columns)
-            i=0
-            for column in columns:
+        def change_columns(dataset_stats):
+            renamed_stats = {}
+            for column,value in dataset_stats.items():
                 if '$\mathregular{CR_{SD}}$' in column:
                     if 'Overlap:' in column:
-                        columns[i] = 'Overlap: Prior - CRsd'
+                        column = 'Overlap: Prior - CRsd'
                     if 'Avg.:' in column:
-                        columns[i] = 'Avg.: CRsd'
+                        column = 'Avg.: CRsd'
                 elif '$\mathregular{BOLD_{SD}}$' in column:
                     if 'Overlap:' in column:
-                        columns[i] = 'Overlap: Prior - BOLDsd'
+                        column = 'Overlap: Prior - BOLDsd'
                     if 'Avg.:' in column:
-                        columns[i] = 'Avg.: BOLDsd'
-                i+=1
-            df.columns = columns
-            return df
+                        column = 'Avg.: BOLDsd'
+                renamed_stats[column] = value
+            return renamed_stats
                         
 
+        # the template display scaling is the same for every network, so it is computed only once
+        scaled = otsu_scaling(template_file)
+
         def analysis_QC_network_i(i,FC_maps,prior_map,non_zero_mask, corr_variable, variable_name, template_file, out_dir_parametric, out_dir_non_parametric,analysis_prefix):
 
             for non_parametric,out_dir in zip([False, True], [out_dir_parametric, out_dir_non_parametric]):
-                dataset_stats,fig,fig_unthresholded = analysis_QC(FC_maps, prior_map, non_zero_mask, corr_variable, variable_name, template_file, non_parametric=non_parametric)
-                df = pd.DataFrame(dataset_stats, index=[1])
-                df = change_columns(df)
-                df.to_csv(f'{out_dir}/{analysis_prefix}{i}_QC_stats.csv', index=None)
+                dataset_stats,fig,fig_unthresholded = analysis_QC(FC_maps, prior_map, non_zero_mask, corr_variable, variable_name, template_file, non_parametric=non_parametric, scaled=scaled)
+                # the single row of stats is written directly, without building a DataFrame
+                dataset_stats = change_columns(dataset_stats)
+                with open(f'{out_dir}/{analysis_prefix}{i}_QC_stats.csv', 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=list(dataset_stats.keys()), lineterminator='\n')
+                    writer.writeheader()
+                    # missing values are written as empty fields, as with DataFrame.to_csv
+                    writer.writerow({key: '' if pd.isna(value) else value for key,value in dataset_stats.items()})
                 fig_path = f'{out_dir}/{analysis_prefix}{i}_QC_maps.{figure_format}'
                 fig.savefig(fig_path, bbox_inches='tight')
                 fig_path = f'{out_dir}/{analysis_prefix}{i}_QC_maps_unthresholded.{figure_format}'
@@ -370,99 +409,74 @@ class DatasetDiagnosis(BaseInterface):
 
         scan_QC_thresholds = self.inputs.scan_QC_thresholds
 
-
-        DR_maps_list=np.array(FC_maps_dict['DR'])
-
-        if self.inputs.group_avg_prior:
-            num_priors = DR_maps_list.shape[1]
-            prior_maps = np.median(DR_maps_list,axis=0)[:,non_zero_voxels]
-        else:
-            prior_maps = scan_data['prior_maps'][:,non_zero_voxels]
+        def QC_over_priors(maps_list, prior_maps, network_weighting, analysis, analysis_prefix):
+            # run the outlier detection and group statistics for each network from a given analysis
             num_priors = prior_maps.shape[0]
-
-        for i in range(num_priors):
-            if self.inputs.network_weighting=='relative':
-                network_var=None
-            else:
-                # we don't apply the non_zero_voxels mask as it changes the original variance estimate
-                network_var = np.sqrt((DR_maps_list[:,i,:] ** 2).sum(axis=1)) # the component variance/scaling is taken from the spatial maps
-            DR_i_scan_QC_thresholds=prep_QC_thresholds_i(scan_QC_thresholds, analysis='DR', network_i=i, num_priors=num_priors)
-
-            FC_maps = DR_maps_list[:,i,non_zero_voxels]
-            QC_inclusion = distribution_network_i(i,prior_maps[i,:],FC_maps,network_var,np.array(DR_conf_corr_dict['DR'])[:,i],total_CRsd, mean_FD_array, tdof_array, scan_name_list, self.inputs.outlier_threshold, out_dir_dist,scan_QC_thresholds=DR_i_scan_QC_thresholds, analysis_prefix='DR')
-
-            # compute group stats only if there is at least 3 scans
-            if QC_inclusion.sum()>2:
-                # apply QC inclusion
-                FC_maps_ = FC_maps[QC_inclusion,:]
-                corr_variable_ = [var[QC_inclusion,:] for var in corr_variable]
-
-                analysis_QC_network_i(i,FC_maps_,prior_maps[i,:],non_zero_mask, corr_variable_, variable_name, template_file, out_dir_parametric, out_dir_non_parametric, analysis_prefix='DR')
-
-
-        NPR_maps_list=np.array(FC_maps_dict['NPR'])
-        if NPR_maps_list.shape[1]>0:
-            if self.inputs.group_avg_prior:
-                num_priors = NPR_maps_list.shape[1]
-                prior_maps = np.median(NPR_maps_list,axis=0)[:,non_zero_voxels]
-            else:
-                prior_maps = scan_data['prior_maps'][:,non_zero_voxels]
-                num_priors = prior_maps.shape[0]
-
+            DR_conf_corr = np.array(DR_conf_corr_dict[analysis])
             for i in range(num_priors):
-                if self.inputs.network_weighting=='relative':
+                if network_weighting=='relative':
                     network_var=None
                 else:
                     # we don't apply the non_zero_voxels mask as it changes the original variance estimate
-                    network_var = np.sqrt((NPR_maps_list[:,i,:] ** 2).sum(axis=1)) # the component variance/scaling is taken from the spatial maps
+                    network_var = np.sqrt((maps_list[:,i,:] ** 2).sum(axis=1)) # the component variance/scaling is taken from the spatial maps
 
-                NPR_i_scan_QC_thresholds=prep_QC_thresholds_i(scan_QC_thresholds, analysis='NPR', network_i=i, num_priors=num_priors)
+                QC_thresholds_i=prep_QC_thresholds_i(scan_QC_thresholds, analysis=analysis, network_i=i, num_priors=num_priors)
 
-                FC_maps = NPR_maps_list[:,i,non_zero_voxels]
-                QC_inclusion = distribution_network_i(i,prior_maps[i,:],FC_maps,network_var,np.array(DR_conf_corr_dict['NPR'])[:,i],total_CRsd, mean_FD_array, tdof_array, scan_name_list, self.inputs.outlier_threshold, out_dir_dist,scan_QC_thresholds=NPR_i_scan_QC_thresholds, analysis_prefix='NPR')
+                FC_maps = np.take(maps_list[:,i,:], non_zero_idx, axis=1)
+                QC_inclusion = distribution_network_i(i,prior_maps[i,:],FC_maps,network_var,DR_conf_corr[:,i],total_CRsd, mean_FD_array, tdof_array, scan_name_list, self.inputs.outlier_threshold, out_dir_dist,scan_QC_thresholds=QC_thresholds_i, analysis_prefix=analysis_prefix)
 
                 # compute group stats only if there is at least 3 scans
                 if QC_inclusion.sum()>2:
-                    # apply QC inclusion
-                    FC_maps_ = FC_maps[QC_inclusion,:]
-                    corr_variable_ = [var[QC_inclusion,:] for var in corr_variable]
+                    if QC_inclusion.all(): # no need to copy the arrays if all scans are included
+                        FC_maps_ = FC_maps
+                        corr_variable_ = corr_variable
+                    else:
+                        # apply QC inclusion
+                        FC_maps_ = FC_maps[QC_inclusion,:]
+                        corr_variable_ = [var[QC_inclusion,:] for var in corr_variable]
+
+                    analysis_QC_network_i(i,FC_maps_,prior_maps[i,:],non_zero_mask, corr_variable_, variable_name, template_file, out_dir_parametric, out_dir_non_parametric, analysis_prefix=analysis_prefix)
 
-                    analysis_QC_network_i(i,FC_maps_,prior_maps[i,:],non_zero_mask, corr_variable_, variable_name, template_file, out_dir_parametric, out_dir_non_parametric, analysis_prefix='NPR')
 
-        seed_maps_list=np.array(FC_maps_dict['SBC'])
+        # the prior maps are shared across scans, and are masked once for both DR and NPR
+        ICA_prior_maps = np.ascontiguousarray(
+            np.take(included_scans[0]['prior_maps'], non_zero_idx, axis=1), dtype=np.float32)
+
+        DR_maps_list=FC_maps_dict['DR']
+        if self.inputs.group_avg_prior:
+            prior_maps = np.take(np.median(DR_maps_list,axis=0), non_zero_idx, axis=1)
+        else:
+            prior_maps = ICA_prior_maps
+        QC_over_priors(DR_maps_list, prior_maps, self.inputs.network_weighting, analysis='DR', analysis_prefix='DR')
+
+        NPR_maps_list=FC_maps_dict['NPR']
+        if NPR_maps_list.shape[1]>0:
+            if self.inputs.group_avg_prior:
+                prior_maps = np.take(np.median(NPR_maps_list,axis=0), non_zero_idx, axis=1)
+            else:
+                prior_maps = ICA_prior_maps
+            QC_over_priors(NPR_maps_list, prior_maps, self.inputs.network_weighting, analysis='NPR', analysis_prefix='NPR')
+
+        seed_maps_list=FC_maps_dict['SBC']
         if seed_maps_list.shape[1]>0:
 
             if self.inputs.group_avg_prior:
-                num_priors = seed_maps_list.shape[1]
-                prior_maps = np.median(seed_maps_list,axis=0)[:,non_zero_voxels]
+                prior_maps = np.take(np.median(seed_maps_list,axis=0), non_zero_idx, axis=1)
 
             # prior maps are provided for seed-FC, tries to run the diagnosis on seeds
             elif len(self.inputs.seed_prior_maps)>0:
-                prior_maps=[]
-                for prior_map in self.inputs.seed_prior_maps:
-                    # resample to match the subject
-                    sitk_img = sitk.Resample(sitk.ReadImage(prior_map), sitk.ReadImage(mask_file))
-                    prior_maps.append(sitk.GetArrayFromImage(sitk_img)[volume_indices])
-                prior_maps = np.array(prior_maps)[:,non_zero_voxels]
-                num_priors = prior_maps.shape[0]
+                # resample to match the subject; the mask image read above is re-used as reference
+                prior_maps = np.empty([len(self.inputs.seed_prior_maps), len(non_zero_idx)], dtype=np.float32)
+                for prior_i,prior_map in enumerate(self.inputs.seed_prior_maps):
+                    resampled = sitk.Resample(sitk.ReadImage(prior_map), mask_img, sitk.Transform(),
+                                              sitk.sitkLinear, 0.0, sitk.sitkFloat32)
+                    # the resampled image is kept in scope while its array view is read
+                    prior_maps[prior_i] = sitk.GetArrayViewFromImage(resampled)[volume_indices][non_zero_idx]
             else:
                 raise
-            
-            for i in range(num_priors):
-                network_var=None
-
-                SBC_i_scan_QC_thresholds=prep_QC_thresholds_i(scan_QC_thresholds, analysis='SBC', network_i=i, num_priors=num_priors)
-
-                FC_maps = seed_maps_list[:,i,non_zero_voxels]
-                QC_inclusion = distribution_network_i(i,prior_maps[i,:],FC_maps,network_var,np.array(DR_conf_corr_dict['SBC'])[:,i],total_CRsd, mean_FD_array, tdof_array, scan_name_list, self.inputs.outlier_threshold, out_dir_dist,scan_QC_thresholds=SBC_i_scan_QC_thresholds, analysis_prefix='seed_FC')
-
-                # compute group stats only if there is at least 3 scans
-                if QC_inclusion.sum()>2:
-                    # apply QC inclusion
-                    FC_maps_ = FC_maps[QC_inclusion,:]
-                    corr_variable_ = [var[QC_inclusion,:] for var in corr_variable]
 
-                    analysis_QC_network_i(i,FC_maps_,prior_maps[i,:],non_zero_mask, corr_variable_, variable_name, template_file, out_dir_parametric, out_dir_non_parametric, analysis_prefix='seed_FC')
+            # the network amplitude is not evaluated for seed-FC
+            QC_over_priors(seed_maps_list, prior_maps, 'relative', analysis='SBC', analysis_prefix='seed_FC')
 
         setattr(self, 'analysis_QC',
                 out_dir_global)
@@ -911,6 +911,15 @@ def get_parser():
             "(default: %(default)s)\n"
             "\n"
         )
+    analysis.add_argument(
+        "--skip_scan_figures", dest='skip_scan_figures', action='store_true',
+        help=
+            "Select this option to skip rendering the scan-level diagnosis figures during --data_diagnosis. \n"
+            "Empty placeholder files are written instead, while the spatial/temporal features and the \n"
+            "dataset-level reports are still generated. This can save substantial time on large datasets. \n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
 
     analysis.add_argument(
         '--seed_list', type=str,
@@ -215,8 +215,8 @@ def init_bold_main_wf(opts, output_folder, number_functional_scans, inho_cor_onl
                 from rabies.preprocess_pkg.bold_ref import _get_vols_to_discard
 
                 in_nii = sitk.ReadImage(bold_file)
-                data_array = sitk.GetArrayFromImage(in_nii)
-                n_volumes_to_discard = _get_vols_to_discard(in_nii)
+                data_array = sitk.GetArrayViewFromImage(in_nii)
+                n_volumes_to_discard = _get_vols_to_discard(data_array)
                 if (not n_volumes_to_discard == 0):
                     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
                     out_bold_file = os.path.abspath(
@@ -104,9 +104,14 @@ class EstimateReferenceImage(BaseInterface):
         if not in_nii.GetDimension()==4:
             raise ValueError(f"Input image {self.inputs.in_file} is not 4-dimensional.")
 
-        data_array = sitk.GetArrayFromImage(in_nii)
+        # the timeseries is only read from, so a view avoids copying the full 4D array
+        data_array = sitk.GetArrayViewFromImage(in_nii)
 
-        n_volumes_to_discard = _get_vols_to_discard(in_nii)
+        # dummy scans are only used if detect_dummy is selected
+        if self.inputs.detect_dummy:
+            n_volumes_to_discard = _get_vols_to_discard(data_array)
+        else:
+            n_volumes_to_discard = 0
 
         filename_split = pathlib.Path(self.inputs.in_file).name.rsplit(".nii")
         out_ref_fname = os.path.abspath(
@@ -130,17 +135,22 @@ class EstimateReferenceImage(BaseInterface):
             # select a set of 50 frames spread uniformally across time to avoid temporal biases
             subset_idx = np.linspace(0,num_timepoints-1,50).astype(int)
             data_slice = data_array[subset_idx,:,:,:]
+            # the intermediate images are only inputs to antsMotionCorr, so they are written
+            # uncompressed to avoid gzip encoding/decoding
             if num_timepoints > 50:
-                slice_fname = os.path.abspath("slice.nii.gz")
+                slice_fname = os.path.abspath("slice.nii")
                 image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
                     data_slice, isVector=False), in_nii, in_nii)
                 sitk.WriteImage(image_4d, slice_fname)
             else:
                 slice_fname = self.inputs.in_file
 
-            median_fname = os.path.abspath("median.nii.gz")
+            # the median buffer is re-used across iterations; the inputs are copies that are not re-used
+            # after the median, so they can be partially sorted in place
+            median_buf = np.empty(data_slice.shape[1:], dtype=np.result_type(data_slice.dtype, np.float32))
+            median_fname = os.path.abspath("median.nii")
             image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-                np.median(data_slice, axis=0), isVector=False), in_nii)
+                np.median(data_slice, axis=0, overwrite_input=True, out=median_buf), isVector=False), in_nii)
             sitk.WriteImage(image_3d, median_fname)
 
             # First iteration to generate reference image.
@@ -148,8 +158,8 @@ class EstimateReferenceImage(BaseInterface):
                                  ref_file=median_fname, prebuilt_option=self.inputs.HMC_option, transform_type='Rigid', second=False, rabies_data_type=self.inputs.rabies_data_type).run()
 
             median = np.median(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), axis=0)
-            tmp_median_fname = os.path.abspath("tmp_median.nii.gz")
+                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), axis=0, overwrite_input=True, out=median_buf)
+            tmp_median_fname = os.path.abspath("tmp_median.nii")
             image_3d = copyInfo_3DImage(
                 sitk.GetImageFromArray(median, isVector=False), in_nii)
             sitk.WriteImage(image_3d, tmp_median_fname)
@@ -164,10 +174,10 @@ class EstimateReferenceImage(BaseInterface):
                 res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), 0.05, axis=0)
 
         # median_image_data is a 3D array of the median image, so creates a new nii image
-        # saves it
+        # saves it; the trimmed mean is computed in float64, so the image is cast back to rabies_data_type
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
             median_image_data, isVector=False), in_nii)
-        sitk.WriteImage(image_3d, out_ref_fname)
+        sitk.WriteImage(sitk.Cast(image_3d, self.inputs.rabies_data_type), out_ref_fname)
 
         # denoise the resulting reference image through non-local mean denoising
         # Denoising reference image.
@@ -182,12 +192,15 @@ class EstimateReferenceImage(BaseInterface):
         return {'ref_image': getattr(self, 'ref_image')}
 
 
-def _get_vols_to_discard(img):
+def _get_vols_to_discard(data_array):
     '''
-    Takes a nifti file, extracts the mean signal of the first 50 volumes and computes which are outliers.
+    Takes the array of a 4D EPI (time first), extracts the mean signal of the first 50 volumes and computes which are outliers.
     is_outlier function: computes Modified Z-Scores (https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm) to determine which volumes are outliers.
     '''
     from nipype.algorithms.confounds import is_outlier
-    data_slice = sitk.GetArrayFromImage(img)[:50, :, :, :]
-    global_signal = data_slice.mean(axis=-1).mean(axis=-1).mean(axis=-1)
+    # only the first 50 volumes are needed; the caller's array (or view) is sliced without copying
+    data_slice = data_array[:50, :, :, :]
+    # the spatial average of each volume is computed as a single matrix-vector product
+    flat = data_slice.reshape(data_slice.shape[0], -1)
+    global_signal = flat.dot(np.ones(flat.shape[1], dtype=np.result_type(flat.dtype, np.float32)))/flat.shape[1]
     return is_outlier(global_signal)
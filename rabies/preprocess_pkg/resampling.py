@@ -80,8 +80,11 @@ def init_bold_preproc_trans_wf(opts, resampling_dim, name='bold_native_trans_wf'
             fields=['bold', 'bold_ref', 'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels', 'raw_brain_mask']),
         name='outputnode')
 
+    # the volumes are resampled in parallel only when motion realignment is applied volume-wise
+    bold_transform_n_procs = 1 if opts.apply_slice_mc else int(opts.local_threads/4)+1
     bold_transform = pe.Node(slice_applyTransforms(
-        rabies_data_type=opts.data_type), name='bold_transform', mem_gb=1*opts.scale_min_memory)
+        rabies_data_type=opts.data_type, n_procs=bold_transform_n_procs),
+        name='bold_transform', mem_gb=bold_transform_n_procs*opts.scale_min_memory, n_procs=bold_transform_n_procs)
     bold_transform.inputs.apply_motcorr = (not opts.apply_slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
     bold_transform.inputs.interpolation = opts.interpolation
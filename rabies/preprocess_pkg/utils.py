@@ -1,3 +1,4 @@
+import functools
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
     File, BaseInterface
@@ -52,20 +53,14 @@ def prep_bids_iter(layout, bids_filter, bold_only=False, inclusion_list=['all'],
 
     bold_dict = {}
     for bold in bold_bids:
-        sub = bold.get_entities()['subject']
-        try:
-            ses = bold.get_entities()['session']
-        except:
-            ses = None
+        entities = bold.get_entities()
+        sub = entities['subject']
+        ses = entities.get('session', None)
+        run = entities.get('run', None)
 
-        try:
-            run = bold.get_entities()['run']
-        except:
-            run = None
-
-        if sub not in list(bold_dict.keys()):
+        if sub not in bold_dict:
             bold_dict[sub] = {}
-        if ses not in list(bold_dict[sub].keys()):
+        if ses not in bold_dict[sub]:
             bold_dict[sub][ses] = {}
 
         bold_list = layout.get(subject=sub, session=ses, run=run, 
@@ -113,6 +108,14 @@ def prep_bids_iter(layout, bids_filter, bold_only=False, inclusion_list=['all'],
     return split_name, scan_info, run_iter, structural_scan_list, number_functional_scans
 
 
+@functools.lru_cache(maxsize=4)
+def _get_layout(bids_dir):
+    # indexing the BIDS directory is costly, so the layout is built once per process and
+    # re-used across the BIDSDataGraber nodes executed by the same worker
+    from bids.layout import BIDSLayout
+    return BIDSLayout(bids_dir, validate=False)
+
+
 class BIDSDataGraberInputSpec(BaseInterfaceInputSpec):
     bids_dir = traits.Str(exists=True, mandatory=True,
                           desc="BIDS data directory")
@@ -149,8 +152,7 @@ class BIDSDataGraber(BaseInterface):
         if not run is None:
             bids_filter['run'] = run
 
-        from bids.layout import BIDSLayout
-        layout = BIDSLayout(self.inputs.bids_dir, validate=False)
+        layout = _get_layout(self.inputs.bids_dir)
         try:
             file_list = layout.get(extension=['nii', 'nii.gz'], return_type='filename', **bids_filter)
             if len(file_list) > 1:
@@ -1,4 +1,5 @@
 import os
+import functools
 import pathlib  # Better path manipulation
 import SimpleITK as sitk
 import numpy as np
@@ -56,11 +57,7 @@ def resample_image_spacing(image, output_spacing):
     resampled_image = sitk.Resample(image, output_size, identity, sitk.sitkBSpline,
                                     image.GetOrigin(), output_spacing, image.GetDirection())
     # clip potential negative values
-    array = sitk.GetArrayFromImage(resampled_image)
-    array[(array < 0).astype(bool)] = 0
-    pos_resampled_image = sitk.GetImageFromArray(array, isVector=False)
-    pos_resampled_image.CopyInformation(resampled_image)
-    return pos_resampled_image
+    return sitk.Clamp(resampled_image, lowerBound=0)
 
 
 def resample_image_spacing_4d(image_4d, output_spacing, clip_negative=True): 
@@ -87,17 +84,13 @@ def resample_image_spacing_4d(image_4d, output_spacing, clip_negative=True):
     for i in range(input_size[3]):
         resampled_image = sitk.Resample(image_4d[:,:,:,i], output_size, identity, sitk.sitkLinear,
                                         origin, output_spacing, direction_3d)
+        if clip_negative:
+            # clip potential negative values; the ClampImageFilter of the pinned SimpleITK (2.0.2) is not
+            # instantiated for 4D images, so it is applied to each volume before joining them
+            resampled_image = sitk.Clamp(resampled_image, lowerBound=0)
         resampled_list.append(resampled_image)
     combined = sitk.JoinSeries(resampled_list) 
     resampled_4d = copyInfo_4DImage(combined, resampled_image, image_4d)
-
-    if clip_negative:
-        # clip potential negative values
-        array = sitk.GetArrayFromImage(resampled_4d)
-        array[(array < 0).astype(bool)] = 0
-        pos_resampled_image = sitk.GetImageFromArray(array, isVector=False)
-        pos_resampled_image.CopyInformation(resampled_4d)
-        resampled_4d = pos_resampled_image
     return resampled_4d
 
 
@@ -142,6 +135,14 @@ def copyInfo_3DImage(image_3d, ref_3d):
     return image_3d
 
 
+@functools.lru_cache(maxsize=4)
+def _resample_reference(ref_file, mtime, rabies_data_type, spacing):
+    # the same reference is typically resampled for every scan of a dataset, so the result is
+    # cached for the nodes executed by the same worker; the modification time is part of the key
+    # to avoid re-using a stale image
+    return resample_image_spacing(sitk.ReadImage(ref_file, rabies_data_type), spacing)
+
+
 class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="Input 4D EPI")
     ref_file = File(exists=True, mandatory=True,
@@ -159,6 +160,8 @@ class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
         desc="Select the interpolator for antsApplyTransform.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of volumes to resample in parallel.")
 
 
 class slice_applyTransformsOutputSpec(TraitedSpec):
@@ -171,6 +174,8 @@ class slice_applyTransforms(BaseInterface):
     This interface will apply a set of transforms to an input 4D EPI as well as motion realignment if specified.
     Susceptibility distortion correction can be applied through the provided transforms. A list of the corrected
     single volumes will be provided as outputs, and these volumes require to be merged to recover timeseries.
+    If motion realignment is not applied, the timeseries is instead resampled in a single call, and the
+    output list contains only the resampled 4D image.
     """
 
     input_spec = slice_applyTransformsInputSpec
@@ -186,40 +191,49 @@ class slice_applyTransforms(BaseInterface):
             spacing = (float(shape[0]), float(shape[1]), float(shape[2]))
         else:
             spacing = img.GetSpacing()[:3]
-        resampled = resample_image_spacing(sitk.ReadImage(
-            self.inputs.ref_file, self.inputs.rabies_data_type), spacing)
-        sitk.WriteImage(resampled, 'resampled.nii.gz')
+        ref_file = os.path.abspath(self.inputs.ref_file)
+        resampled = _resample_reference(ref_file, os.path.getmtime(ref_file),
+                                        self.inputs.rabies_data_type, tuple(spacing))
+        # the reference is read by every antsApplyTransforms call, so it is written uncompressed
+        sitk.WriteImage(resampled, 'resampled.nii')
+        ref_img = os.path.abspath('resampled.nii')
+
+        if not self.inputs.apply_motcorr:
+            # the same transforms apply to every volume, so the timeseries is resampled
+            # as a single 4D image instead of being split into volumes
+            warped_fname = os.path.abspath("deformed_timeseries.nii.gz")
+            exec_applyTransforms(self.inputs.transforms, self.inputs.inverses, self.inputs.in_file, ref_img, 
+                                 warped_fname, interpolation=self.inputs.interpolation, timeseries=True)
+            setattr(self, 'out_files', [warped_fname])
+            return runtime
 
         # Splitting bold file into lists of single volumes
         [bold_volumes, num_volumes] = split_volumes(
             self.inputs.in_file, "bold_", self.inputs.rabies_data_type)
 
-        if self.inputs.apply_motcorr:
-            motcorr_params = self.inputs.motcorr_params
-        ref_img = os.path.abspath('resampled.nii.gz')
-        warped_volumes = []
+        motcorr_params = self.inputs.motcorr_params
+        warped_volumes = [os.path.abspath(
+            "deformed_volume" + str(x) + ".nii.gz") for x in range(0, num_volumes)]
 
         orig_transforms = self.inputs.transforms
         orig_inverses = self.inputs.inverses
-        for x in range(0, num_volumes):
-            warped_vol_fname = os.path.abspath(
-                "deformed_volume" + str(x) + ".nii.gz")
-            warped_volumes.append(warped_vol_fname)
+        def warp_volume(x):
+            warped_vol_fname = warped_volumes[x]
 
-            if self.inputs.apply_motcorr:
-                command = f'antsMotionCorrStats -m {motcorr_params} -o motcorr_vol{x}.mat -t {x}'
-                rc,c_out = run_command(command)
+            command = ['antsMotionCorrStats', '-m', motcorr_params, '-o', f'motcorr_vol{x}.mat', '-t', str(x)]
+            rc,c_out = run_command(command)
 
-                transforms = orig_transforms+[f'motcorr_vol{x}.mat']
-                inverses = orig_inverses+[0]
-            else:
-                transforms = orig_transforms
-                inverses = orig_inverses
+            transforms = orig_transforms+[f'motcorr_vol{x}.mat']
+            inverses = orig_inverses+[0]
 
+            # the volumes are cast to rabies_data_type when they are read by Merge
             exec_applyTransforms(transforms, inverses, bold_volumes[x], ref_img, warped_vol_fname, interpolation=self.inputs.interpolation)
-            # change image to specified data type
-            sitk.WriteImage(sitk.ReadImage(warped_vol_fname,
-                                           self.inputs.rabies_data_type), warped_vol_fname)
+
+        # each volume is resampled independently by ANTs subprocesses, so threads are sufficient
+        # to run them in parallel
+        from multiprocessing.pool import ThreadPool
+        with ThreadPool(processes=self.inputs.n_procs) as pool:
+            pool.map(warp_volume, range(0, num_volumes))
 
         setattr(self, 'out_files', warped_volumes)
         return runtime
@@ -228,22 +242,27 @@ class slice_applyTransforms(BaseInterface):
         return {'out_files': getattr(self, 'out_files')}
 
 
-def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_image, interpolation):
+def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_image, interpolation, timeseries=False):
     # tranforms is a list of transform files, set in order of call within antsApplyTransforms
-    transform_string = ""
+    # if timeseries=True, the input is a 4D image and the transforms are applied to each volume
+    # the arguments are passed as a list, since this is called for every volume of a timeseries
+    transform_args = []
     for transform, inverse in zip(transforms, inverses):
         if transform=='NULL':
             continue
         elif bool(inverse):
-            transform_string += f"-t [{transform},1] "
+            transform_args += ['-t', f"[{transform},1]"]
         else:
-            transform_string += f"-t {transform} "
+            transform_args += ['-t', transform]
+
+    if timeseries:
+        transform_args = ['-d', '3', '-e', '3']+transform_args
 
-    command = f'antsApplyTransforms -i {input_image} {transform_string}-n {interpolation} -r {ref_image} -o {output_image}'
+    command = ['antsApplyTransforms', '-i', input_image]+transform_args+['-n', interpolation, '-r', ref_image, '-o', output_image]
     rc,c_out = run_command(command)
     if not os.path.isfile(output_image):
         raise ValueError(
-            "Missing output image. Transform call failed: "+command)
+            "Missing output image. Transform call failed: "+' '.join(command))
 
 
 def split_volumes(in_file, output_prefix, rabies_data_type):
@@ -258,11 +277,14 @@ def split_volumes(in_file, output_prefix, rabies_data_type):
     if num_dimensions != 4:
         raise ValueError("the input file must be of dimensions 4")
 
+    # the array is extracted once; the volumes are intermediate files for ANTs, so they are
+    # written uncompressed to avoid a gzip encoding/decoding cycle per volume
+    data_array = sitk.GetArrayViewFromImage(in_nii)
     volumes = []
     for x in range(0, num_volumes):
-        data_slice = sitk.GetArrayFromImage(in_nii)[x, :, :, :]
+        data_slice = data_array[x, :, :, :]
         slice_fname = os.path.abspath(
-            output_prefix + "vol" + str(x) + ".nii.gz")
+            output_prefix + "vol" + str(x) + ".nii")
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
             data_slice, isVector=False), in_nii)
         sitk.WriteImage(image_3d, slice_fname)
@@ -288,7 +310,8 @@ class MergeOutputSpec(TraitedSpec):
 
 class Merge(BaseInterface):
     """
-    Takes a list of 3D Nifti files and merge them in the order listed.
+    Takes a list of 3D Nifti files and merge them in the order listed. If a single 4D Nifti file is
+    provided instead, its timeseries is used as is.
     """
 
     input_spec = MergeInputSpec
@@ -300,17 +323,24 @@ class Merge(BaseInterface):
 
         sample_volume = sitk.ReadImage(
             self.inputs.in_files[0], self.inputs.rabies_data_type)
-        length = len(self.inputs.in_files)
-        shape = sitk.GetArrayFromImage(sample_volume).shape
-        combined = np.zeros((length, shape[0], shape[1], shape[2]))
-
-        i = 0
-        for file in self.inputs.in_files:
-            combined[i, :, :, :] = sitk.GetArrayFromImage(
-                sitk.ReadImage(file, self.inputs.rabies_data_type))[:, :, :]
-            i = i+1
-        if (i != length):
-            raise ValueError("Error occured with Merge.")
+        if sample_volume.GetDimension() == 4:
+            if len(self.inputs.in_files) > 1:
+                raise ValueError("Only a single 4D file can be provided to Merge.")
+            combined = sitk.GetArrayFromImage(sample_volume)
+        else:
+            length = len(self.inputs.in_files)
+            sample_array = sitk.GetArrayViewFromImage(sample_volume)
+            # the volumes are read with rabies_data_type, so the timeseries is allocated
+            # directly in that type instead of float64
+            combined = np.empty((length,)+sample_array.shape, dtype=sample_array.dtype)
+
+            i = 0
+            for file in self.inputs.in_files:
+                volume = sitk.ReadImage(file, self.inputs.rabies_data_type)
+                combined[i, :, :, :] = sitk.GetArrayViewFromImage(volume)
+                i = i+1
+            if (i != length):
+                raise ValueError("Error occured with Merge.")
         combined_files = os.path.abspath(
             f"{filename_split[0]}_combined.nii.gz")
 
@@ -340,20 +370,27 @@ class Merge(BaseInterface):
 def run_command(command, verbose = False):
     # Run command and collect stdout
     # http://blog.endpoint.com/2015/01/getting-realtime-output-using-python.html # noqa
+    # the command can be provided as a list of arguments, in which case it is executed
+    # directly without spawning a shell
     from nipype import logging
     log = logging.getLogger('nipype.workflow')
-    log.debug('Running: '+command)
+    use_shell = isinstance(command, str)
+    command_str = command if use_shell else ' '.join(command)
+    log.debug('Running: '+command_str)
 
     import subprocess
     try:
         process = subprocess.run(
             command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
             check=True,
-            shell=True,
+            shell=use_shell,
             )
-    except Exception as e:
+    except subprocess.CalledProcessError as e:
         log.warning(e.output.decode("utf-8"))
         raise
+    except OSError as e:
+        # without a shell, a missing executable raises directly instead of returning an error code
+        raise type(e)(e.errno, f"{e.strerror}. Failed to run: {command_str}", e.filename) from e
 
     c_out = process.stdout.decode("utf-8")
     if not c_out == '':